@@ -1,8 +1,20 @@
-from itertools import chain
+import numpy as np
 
 from multiqc.plots import linegraph
 
 
+def _fill_columns(data, xs):
+    """Return the rows of 'data' as a (len(xs), n_columns) array aligned to the sorted x values 'xs'.
+
+    Rows for x values that are missing from 'data' are filled with zeros.
+    """
+    idx = np.searchsorted(xs, np.fromiter(data.keys(), dtype=np.float64, count=len(data)))
+    vals = np.array(list(data.values()))
+    filled = np.zeros((len(xs), vals.shape[1]), dtype=vals.dtype)
+    filled[idx] = vals
+    return filled
+
+
 def plot_idhist(samples, file_type, **plot_args):
     """Create line graph plot of histogram data for BBMap 'idhist' output.
 
@@ -10,9 +22,7 @@ def plot_idhist(samples, file_type, **plot_args):
     samples = bbmap.MultiqcModule.mod_data[file_type]
     """
 
-    all_x = set()
-    for item in sorted(chain(*[samples[sample]["data"].items() for sample in samples])):
-        all_x.add(item[0])
+    all_x = set().union(*(s["data"].keys() for s in samples.values()))
 
     columns_to_plot = {
         "Reads": {
@@ -23,19 +33,16 @@ def plot_idhist(samples, file_type, **plot_args):
         },
     }
 
-    plot_data = []
-    for column_type in columns_to_plot:
-        plot_data.append(
-            {
-                sample
-                + "."
-                + column_name: {
-                    x: samples[sample]["data"][x][column] if x in samples[sample]["data"] else 0 for x in all_x
-                }
-                for sample in samples
-                for column, column_name in columns_to_plot[column_type].items()
-            }
-        )
+    xs = np.fromiter(sorted(all_x), dtype=np.float64, count=len(all_x))
+    x_keys = xs.tolist()
+
+    # Fill all plotted columns of a sample in one go, so each sample is visited once
+    plot_data = [{} for _ in columns_to_plot]
+    for sample, s in samples.items():
+        filled = _fill_columns(s["data"], xs)
+        for column_data, cols in zip(plot_data, columns_to_plot.values()):
+            for column, column_name in cols.items():
+                column_data[f"{sample}.{column_name}"] = dict(zip(x_keys, filled[:, column].tolist()))
 
     plot_params = {
         "id": "bbmap-" + file_type + "_plot",
@@ -25,10 +25,10 @@ class MultiqcModule(QcmlMultiqcModule):
         # qc data for each sample
         self.qcdata = dict()
         # parse qcml files
-        for f in self.find_log_files('mappingqc', filecontents=True, filehandles=False):
+        for f, quality_parameters in self.parse_qcml_files('mappingqc'):
             self.add_data_source(f)
             s_name = self.clean_s_name(f['s_name'], f['root'])
-            self.qcdata[s_name] = self.parse_qcml(f['f'])
+            self.qcdata[s_name] = quality_parameters
 
         # ignore samples if requested
         self.qcdata = self.ignore_samples(self.qcdata)
@@ -5,38 +5,142 @@
 from multiqc.modules.base_module import BaseMultiqcModule
 from multiqc import config
 from multiqc.plots import table
+from multiqc.utils import report
 
+import io
 import logging
 import collections
-import xml.etree.cElementTree
+import numpy as np
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import mul
+
+try:
+    # use libxml2 through lxml if it is installed, it can also filter elements by tag while parsing
+    from lxml import etree
+    _ITERPARSE_TAG_FILTER = True
+except ImportError:
+    import xml.etree.ElementTree as etree
+    _ITERPARSE_TAG_FILTER = False
 
 # Initialise the logger
 log = logging.getLogger(__name__)
 
+# qcML quality parameter tag in Clark notation, as used for element tags by both etree backends
+_QP_TAG = "{http://www.prime-xs.eu/ms/qcml}qualityParameter"
+# attachments hold base64 encoded plots and make up most of a qcML file
+_ATTACHMENT_TAG = "{http://www.prime-xs.eu/ms/qcml}attachment"
+# 'percentage' suffix of quality parameter names, replaced by '%'
+_PERCENT_RE = re.compile(r' percentage$')
+
+
+def _iter_quality_parameters(source):
+    """Stream a qcML document and yield its qualityParameter elements.
+
+    Elements are cleared once the caller is done with them, and with lxml they are also detached
+    from the tree together with everything parsed before them, so the partial tree stays small.
+    lxml only reports the requested tags, attachments are requested as well so that those following
+    the last quality parameter are freed too.
+    """
+    if _ITERPARSE_TAG_FILTER:
+        for _, elem in etree.iterparse(source, events=('end',), tag=(_QP_TAG, _ATTACHMENT_TAG)):
+            if elem.tag != _ATTACHMENT_TAG:
+                yield elem
+            elem.clear(keep_tail=True)
+            node = elem
+            while node.getparent() is not None:
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+                node = node.getparent()
+    else:
+        for _, elem in etree.iterparse(source, events=('end',)):
+            if elem.tag == _QP_TAG:
+                yield elem
+            elem.clear()
+
 
 class QcmlMultiqcModule(BaseMultiqcModule):
 
-    def parse_qcml(self, qcml_contents):
-        """Parse a qcML file and return key-value pairs from the quality parameter entries."""
-        root = xml.etree.cElementTree.fromstring(qcml_contents)
+    @staticmethod
+    def parse_qcml(qcml_fh):
+        """Parse a qcML file handle opened in binary mode, the qcML declares its own encoding.
+
+        Returns key-value pairs from the quality parameter entries and the description and accession of each
+        quality parameter. Nothing is stored on the module, so files can be parsed in worker threads.
+        """
         quality_parameters = dict()
-        for qp in root.findall(".//{http://www.prime-xs.eu/ms/qcml}qualityParameter"):
+        descriptions = dict()
+        for qp in _iter_quality_parameters(qcml_fh):
+            attr = qp.attrib
+            value = attr['value']
+
             # skip n/a values
-            if qp.attrib['value'].startswith('n/a'):
+            if value[:3] == 'n/a':
                 continue
 
             # replace 'percentage' with '%'
-            qp_name = re.sub(r' percentage$', ' %', qp.attrib['name'])
+            qp_name = _PERCENT_RE.sub(' %', attr['name'])
 
             try:
-                quality_parameters[qp_name] = float(qp.attrib['value'])
+                quality_parameters[qp_name] = float(value)
             except ValueError:
-                quality_parameters[qp_name] = qp.attrib['value']
-
-            self.qcml[qp_name] = {'description': qp.attrib['description'],
-                                  'accession': qp.attrib['accession']}
-        return quality_parameters
+                quality_parameters[qp_name] = value
+
+            # descriptions are the same for every occurrence of a parameter, only store them once
+            if qp_name not in descriptions:
+                descriptions[qp_name] = {'description': attr.get('description', ''),
+                                         'accession': attr.get('accession', '')}
+        return quality_parameters, descriptions
+
+    def parse_qcml_files(self, sp_key):
+        """Find and parse all qcML files for a search pattern key.
+
+        Quality parameter descriptions are merged into self.qcml afterwards, in the order the files were found,
+        the first file describing a parameter wins.
+        Returns a list of (file, quality parameters) tuples in the same order.
+        """
+        files = list(self.find_log_files(sp_key, filecontents=False, filehandles=False))
+
+        parsed = list()
+        for f, result in self._parse_qcml_results(files):
+            if result is None:
+                continue
+            quality_parameters, descriptions = result
+            for qp_name, description in descriptions.items():
+                self.qcml.setdefault(qp_name, description)
+            parsed.append((f, quality_parameters))
+        return parsed
+
+    def _parse_qcml_results(self, files):
+        """Parse qcML files and yield (file, parse result) tuples in file order.
+
+        Files are parsed in a thread pool when lxml is installed and one after another with the ElementTree fallback.
+        report.last_found_file is set to each file before its result is collected, so that a file which fails
+        to parse is the one named in MultiQC's error message.
+        """
+        if _ITERPARSE_TAG_FILTER:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = [executor.submit(self._parse_qcml_file, f) for f in files]
+                for f, future in zip(files, futures):
+                    report.last_found_file = os.path.join(f['root'], f['fn'])
+                    yield f, future.result()
+        else:
+            for f in files:
+                report.last_found_file = os.path.join(f['root'], f['fn'])
+                yield f, self._parse_qcml_file(f)
+
+    def _parse_qcml_file(self, f):
+        """Open and parse a single qcML file found by find_log_files, None if it can't be read."""
+        try:
+            with io.open(os.path.join(f['root'], f['fn']), 'rb') as fh:
+                return self.parse_qcml(fh)
+        except (IOError, OSError) as e:
+            # same handling as for files that find_log_files can't open
+            if config.report_readerrors:
+                log.debug("Couldn't open filehandle when returning file: {}\n{}".format(f['fn'], e))
+            return None
 
     def make_description(self, keynames):
         """"Create description string from qcML quality parameter key name."""
@@ -50,13 +154,7 @@ class QcmlMultiqcModule(BaseMultiqcModule):
     @staticmethod
     def dict_ordered_subset(d, ks):
         """Return subset of a dictionary as an OrderedDict object, ignoring non-existent keys."""
-        od = collections.OrderedDict()
-        for k in ks:
-            try:
-                od[k] = d[k]
-            except KeyError:
-                pass
-        return od
+        return collections.OrderedDict((k, d[k]) for k in ks if k in d)
 
 
 class MultiqcModule(QcmlMultiqcModule):
@@ -72,10 +170,10 @@ class MultiqcModule(QcmlMultiqcModule):
         # qc data for each sample
         self.qcdata = dict()
         # parse qcml files
-        for f in self.find_log_files('readqc', filecontents=True, filehandles=False):
+        for f, quality_parameters in self.parse_qcml_files('readqc'):
             self.add_data_source(f)
             s_name = self.clean_s_name(f['s_name'], f['root'])
-            self.qcdata[s_name] = self.parse_qcml(f['f'])
+            self.qcdata[s_name] = quality_parameters
 
         # ignore samples if requested
         self.qcdata = self.ignore_samples(self.qcdata)
@@ -88,28 +186,36 @@ class MultiqcModule(QcmlMultiqcModule):
         self.qcml.pop('bases sequenced (MB)')
         self.qcml['bases sequenced'] = dict()
         self.qcml['bases sequenced']['description'] = 'Bases sequenced in total.'
-        for _, kv in self.qcdata.items():
-            kv['bases sequenced'] = kv['bases sequenced (MB)'] * 1e6
+        s_names = list(self.qcdata)
+        bases = np.array([self.qcdata[s_name]['bases sequenced (MB)'] for s_name in s_names]) * 1e6
+        for s_name, b in zip(s_names, bases.tolist()):
+            kv = self.qcdata[s_name]
+            kv['bases sequenced'] = b
             kv.pop('bases sequenced (MB)')
 
+        # table header settings per quality parameter, on top of the qcML name and description
+        header_overrides = {
+            'Q20 read %': {'suffix': '%', 'format': '{:,.2f}', 'max': 100, 'scale': 'Reds'},
+            'Q30 base %': {'suffix': '%', 'format': '{:,.2f}', 'max': 100, 'scale': 'Oranges'},
+            'gc content %': {'suffix': '%', 'format': '{:,.2f}', 'max': 100, 'scale': 'Spectral'},
+            'no base call %': {'suffix': '%', 'format': '{:,.2f}', 'floor': 1, 'scale': 'BuGn'},
+            # 'bases sequenced (MB)': {'suffix': 'Mb', 'format': '{:,.2f}'},
+            'bases sequenced': {'suffix': config.base_count_prefix, 'format': '{:,.2f}',
+                                'modify': partial(mul, config.base_count_multiplier),
+                                'scale': 'Blues'},
+            'read count': {'suffix': config.read_count_prefix, 'format': '{:,.2f}',
+                           'modify': partial(mul, config.read_count_multiplier),
+                           'scale': 'Purples'},
+            'read length': {'suffix': 'bp', 'format': '{:,.0f}', 'scale': 'Greens'},
+        }
+
         # prepare table headers, use name and description from qcML
         headers = {qp_key: {
             'namespace': "ReadQC",
             'title': qp_key,
             'description': qp_entry['description'],
+            **header_overrides.get(qp_key, {}),
         } for qp_key, qp_entry in self.qcml.items()}
-        headers['Q20 read %'].update({'suffix': '%', 'format': '{:,.2f}', 'max': 100, 'scale': 'Reds'})
-        headers['Q30 base %'].update({'suffix': '%', 'format': '{:,.2f}', 'max': 100, 'scale': 'Oranges'})
-        headers['gc content %'].update({'suffix': '%', 'format': '{:,.2f}', 'max': 100, 'scale': 'Spectral'})
-        headers['no base call %'].update({'suffix': '%', 'format': '{:,.2f}', 'floor': 1, 'scale': 'BuGn'})
-        # headers['bases sequenced (MB)'].update({'suffix': 'Mb', 'format': '{:,.2f}'})
-        headers['bases sequenced'].update({'suffix': config.base_count_prefix, 'format': '{:,.2f}',
-                                           'modify': lambda x: x * config.base_count_multiplier,
-                                           'scale': 'Blues'})
-        headers['read count'].update({'suffix': config.read_count_prefix, 'format': '{:,.2f}',
-                                      'modify': lambda x: x * config.read_count_multiplier,
-                                           'scale': 'Purples'})
-        headers['read length'].update({'suffix': 'bp', 'format': '{:,.0f}', 'scale': 'Greens'})
 
         # general table: add read count and bases sequenced
         self.general_stats_addcols(self.qcdata,
@@ -25,14 +25,14 @@ class MultiqcModule(QcmlMultiqcModule):
         # qc data for each sample
         self.qcdata = dict()
         # parse qcml files
-        for f in self.find_log_files('somaticqc', filecontents=True, filehandles=False):
+        for f, quality_parameters in self.parse_qcml_files('somaticqc'):
             self.add_data_source(f)
             s_name = self.clean_s_name(f['s_name'], f['root'])
             # try to split Sample1-Sample2 names
             ms = re.match(r'([^-]+)-[^-]+', s_name)
             if (ms):
                 s_name = ms.group(1)
-            self.qcdata[s_name] = self.parse_qcml(f['f'])
+            self.qcdata[s_name] = quality_parameters
 
         # ignore samples if requested
         self.qcdata = self.ignore_samples(self.qcdata)